@@ -0,0 +1,1540 @@
+""" Checks for helpers, run with python -m unittest test_helpers
+
+"""
+import array
+import calendar
+import cPickle
+import json
+import os
+import random
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from cStringIO import StringIO
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+from HTMLParser import HTMLParseError
+
+import pytz
+from bson import ObjectId
+
+import helpers
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _random_objects(random_):
+    """ Picklable objects from tiny to a few ZCHUNK_SIZEs, some that
+    compress to almost nothing
+
+    """
+    yield None
+    yield ''
+    yield {'a': [1, 2.5, u'\xe9', ('t', None)], 'b': datetime(2020, 1, 2)}
+    yield 'x' * (helpers.ZCHUNK_SIZE * 5 + 3)
+    yield ''.join(chr(random_.randint(0, 255))
+        for _ in xrange(helpers.ZCHUNK_SIZE * 2 + 1))
+    for _ in xrange(20):
+        yield [random_.choice(['word', u'w\xf6rd', 7, 1.5, None,
+            'word' * random_.randint(0, 3000)])
+            for _ in xrange(random_.randint(0, 200))]
+
+
+def _random_soup(random_, size):
+    """ Tag soup with text, entities, comments, script, declarations
+    and the odd broken piece that makes HTMLParser give up
+
+    """
+    pieces = ['<p>', '</p>', '<div class="a b">', '</div>', '<br/>',
+        '<a href=\'x?y=1&z=2\'>', '</a>', '&amp;', '&#38;', '&#x26;', '&nbsp',
+        '&', '<!-- note -->', '<script>if (a < b) {}</script>',
+        '<style>p > b {}</style>', '<!DOCTYPE html>', '<?php echo 1 ?>',
+        '<![CDATA[x]]>', '\n', '  ', '<', '>', '</', '<!x', '<![if x]>',
+        '&#', 'text', u'\xe9t\xe9', 'a <b>bold</b> word', '<b', '"',
+        '<![foo[ x ]]>']
+    soup = []
+    while sum(map(len, soup)) < size:
+        if random_.random() < 0.4:
+            soup.append(''.join(random_.choice('abc xyz\t')
+                for _ in xrange(random_.randint(1, 40))))
+        else:
+            soup.append(random_.choice(pieces[:-9] if random_.random() < 0.8
+                else pieces))
+    soup = u''.join(soup)
+    return soup if random_.random() < 0.3 else soup.encode('utf-8')
+
+
+def _random_chunks(random_, text):
+    """ text cut at random places
+
+    """
+    chunks = []
+    pos = 0
+    while pos < len(text):
+        step = random_.choice([1, 2, 7, 64, 1000])
+        chunks.append(text[pos:pos + step])
+        pos += step
+    return chunks
+
+
+class StripTagsTest(unittest.TestCase):
+    """ iter_strip_tags and strip_tags_many against strip_tags on the
+    whole document
+
+    """
+
+    def test_streams_match_whole_documents(self):
+        random_ = random.Random(19)
+        rejected = 0
+        for _ in xrange(400):
+            soup = _random_soup(random_, random_.choice([10, 200, 3000]))
+            expected = helpers.strip_tags(soup)
+            self.assertEqual(''.join(helpers.iter_strip_tags([soup])),
+                expected, repr(soup))
+            try:
+                helpers.MLStripper().feed(soup)
+            except HTMLParseError:
+                # Text yielded before HTMLParser gave up is kept
+                rejected += 1
+                continue
+            self.assertEqual(''.join(helpers.iter_strip_tags(
+                _random_chunks(random_, soup))), expected, repr(soup))
+            if isinstance(soup, str):
+                self.assertEqual(''.join(helpers.iter_strip_tags(
+                    StringIO(soup), random_.randint(1, 300))), expected)
+        self.assertTrue(0 < rejected < 200)
+        self.assertEqual(list(helpers.iter_strip_tags([])), [])
+        self.assertEqual(''.join(helpers.iter_strip_tags(['', 'a', '', 'b'])),
+            'ab')
+
+    def test_pool_matches_strip_tags(self):
+        random_ = random.Random(20)
+        documents = [_random_soup(random_, random_.randint(0, 2000))
+            for _ in xrange(150)]
+        expected = map(helpers.strip_tags, documents)
+        for processes in (1, 2):
+            self.assertEqual(helpers.strip_tags_many(iter(documents),
+                processes, random_.randint(1, 20)), expected)
+
+
+class ZdumpTest(unittest.TestCase):
+    """ zdump/zload against the zlib.compress(cPickle.dumps(obj)) of
+    zdumps before codecs
+
+    """
+
+    def test_same_bytes_as_zdumps(self):
+        for obj in _random_objects(random.Random(4)):
+            legacy = zlib.compress(cPickle.dumps(obj,
+                cPickle.HIGHEST_PROTOCOL))
+            file_ = StringIO()
+            helpers.zdump(obj, file_)
+            self.assertEqual(file_.getvalue(), legacy)
+            self.assertEqual(helpers.zdumps(obj), legacy)
+            self.assertEqual(helpers.zload(StringIO(legacy)), obj)
+            self.assertEqual(helpers.zloads(legacy), obj)
+
+    def test_reader_pieces(self):
+        data = ''.join(chr(idx % 251) for idx in xrange(300000)) + '\n' * 9
+        reader = helpers._ZlibReader(StringIO(zlib.compress(data, 1)),
+            chunk_size=1000)
+        random_ = random.Random(5)
+        parts = []
+        while not parts or parts[-1]:
+            if random_.random() < 0.3:
+                parts.append(reader.readline())
+            else:
+                parts.append(reader.read(random_.randint(1, 7000)))
+        self.assertEqual(''.join(parts), data)
+
+
+class CodecTest(unittest.TestCase):
+    """ The codec framing header against headerless legacy blobs
+
+    """
+
+    def test_codecs_and_levels(self):
+        doc = {'a': range(1000), 'when': datetime(2020, 1, 2), 'id': ObjectId()}
+        self.assertEqual(helpers.jzdumps(doc),
+            zlib.compress(json.dumps(helpers.json_prep(doc))))
+        self.assertEqual(helpers.jzloads(zlib.compress(json.dumps(
+            helpers.json_prep(doc)))), json.loads(json.dumps(
+            helpers.json_prep(doc))))
+        for obj in _random_objects(random.Random(6)):
+            for name, codec in helpers.CODECS.items():
+                for level in (None, 1, codec.default_level):
+                    zstr = helpers.zdumps(obj, name, level)
+                    self.assertEqual(zstr[:3], helpers.CODEC_MAGIC +
+                        chr(codec.codec_id) + chr(level or
+                        codec.default_level))
+                    self.assertEqual(codec.decompress(zstr[3:]),
+                        cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL))
+                    self.assertEqual(helpers.zloads(zstr), obj)
+                    self.assertEqual(helpers.zload(StringIO(zstr)), obj)
+            for level in (0, 9):
+                file_ = StringIO()
+                helpers.zdump(obj, file_, level)
+                zstr = helpers.zdumps(obj, 'zlib', level)
+                # stored blocks at level 0 follow the writes
+                if level:
+                    self.assertEqual(file_.getvalue(), zstr)
+                self.assertEqual(file_.getvalue()[:3], zstr[:3])
+                self.assertEqual(helpers.zloads(file_.getvalue()), obj)
+
+    def test_bad_arguments(self):
+        for level in (-1, 10, 256):
+            self.assertRaises(ValueError, helpers.zdump, 1, StringIO(), level)
+        self.assertRaises(ValueError, helpers.zdumps, 1, 'zlib', 256)
+        self.assertRaises(ValueError, helpers.zdumps, 1, 'nope')
+        self.assertRaises(ValueError, helpers.zloads, '\xff\xee\x01x')
+        for codec_id in (helpers.ZDICT_CODEC_ID, helpers.ZBLOCKS_CODEC_ID,
+                helpers.ZOOB_CODEC_ID, 256, helpers.CODECS['zlib'].codec_id):
+            self.assertRaises(ValueError, helpers.register_codec, 'other',
+                codec_id, zlib.compress, zlib.decompress, 6)
+
+
+class ZdictTest(unittest.TestCase):
+    """ Preset dictionary blobs against the plain zlib stream they
+    continue
+
+    """
+
+    def setUp(self):
+        random_ = random.Random(7)
+        self.records = [{'user': 'u%d' % random_.randint(0, 99),
+            'tags': random_.sample(['red', 'green', 'blue', 'amber'], 2),
+            'score': random_.random(), 'when': datetime(2020, 1,
+            random_.randint(1, 28))} for _ in xrange(600)]
+        self.zdict = helpers.train_zdict([helpers.json_encode(record)
+            for record in self.records[:300]], 60001)
+
+    def tearDown(self):
+        helpers.ZLIB_DICTIONARIES.pop(60001, None)
+
+    def test_continues_a_primed_stream(self):
+        zdict = self.zdict
+        self.assertTrue(0 < len(zdict.data) <= helpers.ZDICT_SIZE)
+        for level in (1, 6, 9):
+            compressor = zlib.compressobj(level, zlib.DEFLATED, zdict._wbits)
+            prefix = compressor.compress(zdict.data) + compressor.flush(
+                zlib.Z_SYNC_FLUSH)
+            for record in self.records[300:350]:
+                data = helpers.json_encode(record)
+                self.assertEqual(zlib.decompress(prefix +
+                    zdict.compress(data, level)), zdict.data + data)
+                self.assertEqual(zdict.decompress(zdict.compress(data,
+                    level)), data)
+
+    def test_blobs_round_trip(self):
+        zdict = self.zdict
+        plain = primed = 0
+        for record in self.records[300:]:
+            jzstr = helpers.jzdumps(record, zdict=zdict)
+            self.assertEqual(jzstr[:5], helpers.CODEC_MAGIC +
+                chr(helpers.ZDICT_CODEC_ID) + chr(6) + '\xea\x61')
+            self.assertEqual(helpers.jzloads(jzstr),
+                helpers.jzloads(helpers.jzdumps(record)))
+            self.assertEqual(helpers.zloads(helpers.zdumps(record,
+                zdict=zdict)), record)
+            plain += len(helpers.jzdumps(record))
+            primed += len(jzstr)
+        self.assertTrue(primed < plain)
+        loaded = cPickle.loads(cPickle.dumps(zdict))
+        self.assertEqual(loaded.decompress(zdict.compress('abc')), 'abc')
+        jzstr = helpers.jzdumps(self.records[0], zdict=zdict)
+        del helpers.ZLIB_DICTIONARIES[60001]
+        self.assertRaises(ValueError, helpers.jzloads, jzstr)
+        self.assertEqual(helpers.jzloads(jzstr, zdict),
+            helpers.jzloads(helpers.jzdumps(self.records[0])))
+        helpers.register_zdict(zdict)
+        self.assertRaises(ValueError, helpers.register_zdict,
+            helpers.ZlibDictionary('other', 60001))
+        self.assertRaises(ValueError, helpers.zdumps, 1, 'bz2', zdict=zdict)
+
+
+class JZRecordTest(unittest.TestCase):
+    """ JZRecordWriter/iter_jzrecords against jzdumps/jzloads per record
+
+    """
+
+    def test_streams_match_jzloads(self):
+        random_ = random.Random(8)
+        records = [{'n': idx, 'when': datetime(2020, 1, 1, idx % 24),
+            'id': ObjectId(), 'text': u'r\xe9cord\n' * random_.randint(0, 500),
+            'nested': [{'a': idx}]} for idx in xrange(3000)]
+        expected = [helpers.jzloads(helpers.jzdumps(record))
+            for record in records]
+        file_ = StringIO()
+        for start, end in ((0, 1000), (1000, 1000), (1000, 3000)):
+            # appended streams, one of them empty
+            with helpers.JZRecordWriter(file_) as writer:
+                for record in records[start:end]:
+                    writer.write(record)
+            self.assertEqual(writer.count, end - start)
+        file_.seek(0)
+        self.assertEqual(list(helpers.iter_jzrecords(file_)), expected)
+
+    def test_flush_makes_records_readable(self):
+        file_ = StringIO()
+        writer = helpers.JZRecordWriter(file_, 9)
+        for idx in xrange(50):
+            writer.write({'n': idx})
+        writer.flush()
+        self.assertEqual(list(helpers.iter_jzrecords(StringIO(
+            file_.getvalue()))), [{'n': idx} for idx in xrange(50)])
+        writer.write({'n': 50})
+        writer.close()
+        # a torn last line is a write that never finished
+        zstr = file_.getvalue() + zlib.compress('{"n": 51}\n{"n": 5')
+        self.assertEqual(list(helpers.iter_jzrecords(StringIO(zstr))),
+            [{'n': idx} for idx in xrange(52)])
+
+
+class BlockTest(unittest.TestCase):
+    """ compress_blocks against zlib over the same slices
+
+    """
+
+    def test_blocks_match_zlib(self):
+        random_ = random.Random(9)
+        for size in (0, 1, 999, 1000, 1001, 5000):
+            data = ''.join(random_.choice('abc\x00') for _ in xrange(size))
+            for threads in (None, 1, 3):
+                zstr = helpers.compress_blocks(data, 3, threads, 1000)
+                self.assertEqual(zstr, helpers.compress_blocks(data, 3,
+                    None, 1000))
+                block_size, index = helpers._block_index(zstr)
+                self.assertEqual((block_size, len(index)),
+                    (1000, (size + 999) // 1000))
+                for block in xrange(len(index)):
+                    piece = data[block * 1000:(block + 1) * 1000]
+                    self.assertEqual(helpers.decompress_block(zstr, block),
+                        piece)
+                    offset, length = index[block]
+                    self.assertEqual(zstr[offset:offset + length],
+                        zlib.compress(piece, 3))
+                self.assertEqual(helpers.decompress(zstr, threads=threads),
+                    data)
+
+    def test_zdumps_threads(self):
+        obj = ['block %d' % idx for idx in xrange(600000)]
+        zstr = helpers.zdumps(obj, threads=2)
+        self.assertEqual(zstr[:3], helpers.CODEC_MAGIC +
+            chr(helpers.ZBLOCKS_CODEC_ID) + chr(6))
+        self.assertEqual(helpers.zloads(zstr), obj)
+        self.assertEqual(helpers.zloads(zstr, threads=2), obj)
+        self.assertEqual(helpers.zload(StringIO(zstr)), obj)
+        for level in (-1, 10, 255):
+            self.assertRaises(ValueError, helpers.compress, 'x', level=level,
+                threads=2)
+        self.assertRaises(ValueError, helpers.compress, 'x', 'bz2', threads=2)
+
+
+class JsonEncodeTest(unittest.TestCase):
+    """ json_encode against json.dumps(json_prep(obj))
+
+    """
+
+    def test_same_bytes_as_json_prep(self):
+        random_ = random.Random(1)
+        for _ in xrange(2000):
+            doc = {}
+            for _ in xrange(random_.randint(1, 40)):
+                doc[random_.choice(['k%d' % random_.randint(0, 10 ** 5),
+                    u'\xe9%d' % random_.randint(0, 999),
+                    random_.randint(-10 ** 6, 10 ** 6)])] = random_.random()
+            for key in list(doc)[:random_.randint(0, 3)]:
+                del doc[key]
+            obj = {'a': doc, 'l': [doc, {'x': [doc]}, (doc, [doc])],
+                'o': OrderedDict(sorted(doc.items())), 'c': Counter(doc),
+                'j': json.loads(json.dumps(doc)), 'p': helpers.json_prep(doc),
+                'dt': datetime(2020, 1, 2, 3, 4, 5), 'id': ObjectId()}
+            self.assertEqual(helpers.json_encode(obj),
+                json.dumps(helpers.json_prep(obj)))
+
+
+class OobTest(unittest.TestCase):
+    """ zdumps(oob=True) round trips of str, bytearray and array.array
+    against the in band pickle
+
+    """
+
+    def test_buffers_round_trip(self):
+        random_ = random.Random(10)
+        size = helpers.OOB_MIN_SIZE
+        noise = ''.join(chr(random_.randint(0, 255)) for _ in xrange(size * 2))
+        text = 'abcd' * size
+        arrays = [array.array(typecode, noise[:size * 2 // 8 * 8])
+            for typecode in 'cbBhHiIlLfd']
+        arrays.append(array.array('u', u'\xe9t\xe9' * size))
+        obj = {'noise': noise, 'text': text, 'again': text,
+            'small': 'x' * (size - 1), 'bytes': bytearray(noise),
+            'zeros': bytearray(size * 3), 'arrays': arrays,
+            'short': array.array('d', [1.5])}
+        zstr = helpers.zdumps(obj, oob=True)
+        self.assertEqual(zstr[:2], helpers.CODEC_MAGIC +
+            chr(helpers.ZOOB_CODEC_ID))
+        def raw(value):
+            # arrays of random bytes hold NaNs, compare their bytes
+            if isinstance(value, list):
+                return [raw(item) for item in value]
+            if isinstance(value, array.array):
+                return value.typecode, value.tostring()
+            return type(value), value
+        loaded = helpers.zloads(zstr)
+        in_band = helpers.zloads(helpers.zdumps(obj))
+        for key, value in obj.iteritems():
+            self.assertEqual(raw(loaded[key]), raw(value), key)
+            if key != 'arrays':
+                # in band float arrays go through floats and lose NaN bits
+                self.assertEqual(raw(loaded[key]), raw(in_band[key]), key)
+        self.assertTrue(loaded['again'] is loaded['text'])
+        loaded['bytes'][0] = 1
+        loaded['arrays'][0][0] = 'x'
+        # text is kept once, small and short stay in the pickle
+        self.assertEqual(struct.unpack_from('>I', zstr, 3)[0],
+            4 + len(arrays))
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class OobNumpyTest(unittest.TestCase):
+    """ zdumps(oob=True) round trips of numpy arrays
+
+    """
+
+    def test_structured_dtype(self):
+        arr = numpy.zeros(10000, dtype=[('a', 'i4'), ('b', 'f8')])
+        arr['a'] = numpy.arange(10000)
+        arr['b'] = 1.5
+        loaded = helpers.zloads(helpers.zdumps({'n': arr}, oob=True))['n']
+        self.assertEqual(loaded.dtype, arr.dtype)
+        self.assertTrue((loaded['a'] == arr['a']).all())
+        self.assertTrue((loaded == arr).all())
+
+    def test_compressed_and_raw_are_writable(self):
+        objs = {'zeros': numpy.zeros((300, 100)),
+            'noise': numpy.random.RandomState(1).rand(300, 100)}
+        loaded = helpers.zloads(helpers.zdumps(objs, oob=True))
+        for key, arr in objs.iteritems():
+            self.assertEqual(loaded[key].shape, arr.shape)
+            self.assertTrue((loaded[key] == arr).all())
+            loaded[key][0, 0] = 7
+
+
+class BlobStoreTest(unittest.TestCase):
+    """ BlobStore recovery
+
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'blobs')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_crash_between_compact_rename_and_index_save(self):
+        store = helpers.BlobStore(self.path)
+        for idx in xrange(20):
+            store.put('key%d' % idx, {'value': idx})
+        store.sync()
+        shutil.copy(self.path + '.idx', self.path + '.stale')
+        for idx in xrange(20):
+            store.put('key%d' % idx, {'value': idx * 10})
+        store.compact()
+        size = os.path.getsize(self.path)
+        store.close()
+        # the index saved before the compact, as if it crashed
+        # before sync wrote the new one
+        shutil.copy(self.path + '.stale', self.path + '.idx')
+
+        store = helpers.BlobStore(self.path)
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.assertEqual(len(store), 20)
+        for idx in xrange(20):
+            self.assertEqual(store.get('key%d' % idx), {'value': idx * 10})
+        store.close()
+
+    def test_deletes_count_as_garbage(self):
+        store = helpers.BlobStore(self.path)
+        for idx in xrange(10):
+            store.put('key%d' % idx, {'value': idx})
+        store.put('key0', {'value': 'new'})
+        for idx in xrange(1, 10):
+            store.delete('key%d' % idx)
+        store.sync()
+        live = store._record_header.size + len('key0') + len(
+            store.get_raw('key0'))
+        size = os.path.getsize(self.path)
+        self.assertEqual(store._garbage, size - store._start - live)
+        self.assertTrue(store.garbage_ratio() > 0.8)
+        store.close()
+        os.remove(self.path + '.idx')
+        store = helpers.BlobStore(self.path)
+        self.assertEqual(store._garbage, size - store._start - live)
+        store.compact()
+        self.assertEqual((store.garbage_ratio(), store.keys()), (0.0,
+            ['key0']))
+        store.close()
+
+    def test_corrupt_record_in_the_middle_is_skipped(self):
+        store = helpers.BlobStore(self.path)
+        for idx in xrange(10):
+            store.put('key%d' % idx, {'value': idx})
+        store.put('key3', {'value': 30})
+        offset = store._index['key5'][0]
+        store.close()
+        size = os.path.getsize(self.path)
+        with open(self.path, 'r+b') as file_:
+            file_.seek(offset + 2)
+            file_.write('\xff\xff\xff')
+        os.remove(self.path + '.idx')
+
+        store = helpers.BlobStore(self.path)
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.assertEqual(sorted(store.keys()), sorted('key%d' % idx
+            for idx in xrange(10) if idx != 5))
+        self.assertEqual(store.get('key3'), {'value': 30})
+        self.assertEqual(store.get('key9'), {'value': 9})
+        store.put('key5', {'value': 50})
+        store.close()
+        store = helpers.BlobStore(self.path)
+        self.assertEqual(store.get('key5'), {'value': 50})
+        store.close()
+
+    def test_torn_tail_is_cut(self):
+        store = helpers.BlobStore(self.path)
+        store.put('a', 1)
+        store.sync()
+        store.put('b', 2)
+        store.close()
+        with open(self.path, 'ab') as file_:
+            file_.write('\x00' * 7)
+        store = helpers.BlobStore(self.path)
+        self.assertEqual((store.get('a'), store.get('b')), (1, 2))
+        store.close()
+
+
+def _legacy_parse_date(datestring, default_timezone=helpers.UTC):
+    """ parse_date before the sliced fast path, regex only
+
+    """
+    tim_ = helpers.ISO8601_REGEX.match(datestring)
+    if not tim_:
+        raise helpers.ParseError("Unable to parse date string %r" % datestring)
+    groups = tim_.groupdict()
+    tz_ = helpers.parse_timezone(groups["timezone"],
+        default_timezone=default_timezone)
+    if groups["fraction"] is None:
+        groups["fraction"] = 0
+    else:
+        groups["fraction"] = int(float("0.%s" % groups["fraction"]) * 1e6)
+    return datetime(int(groups["year"]), int(groups["month"]),
+        int(groups["day"]), int(groups["hour"]), int(groups["minute"]),
+        int(groups["second"]), int(groups["fraction"]), tz_)
+
+
+def _random_datestrings(random_, count):
+    """ ISO 8601 shapes with a few characters changed, dropped or added
+
+    """
+    noise = '0123456789-+:.TZ \n\xe9x'
+    for _ in xrange(count):
+        text = '%04d-%02d-%02d%s%02d:%02d:%02d' % (random_.randint(0, 9999),
+            random_.randint(0, 13), random_.randint(0, 32),
+            random_.choice('T T\n'), random_.randint(0, 25),
+            random_.randint(0, 61), random_.randint(0, 61))
+        if random_.random() < 0.5:
+            text += '.' + ''.join(random_.choice('0123456789')
+                for _ in xrange(random_.randint(0, 9)))
+        text += random_.choice(['', 'Z', '+05:30', '-11:00', '+1:00',
+            '-05:3', '+0530', '+05:30junk'])
+        for _ in xrange(random_.choice([0, 0, 1, 2])):
+            pos = random_.randint(0, len(text))
+            action = random_.randint(0, 2)
+            if action == 0:
+                text = text[:pos] + text[pos + 1:]
+            else:
+                text = text[:pos] + random_.choice(noise) + \
+                    text[pos + action - 1:]
+        if random_.random() < 0.2:
+            text = text.decode('latin-1')
+        yield text
+
+
+class ParseDateTest(unittest.TestCase):
+    """ parse_date against the regex only parser it had before
+
+    """
+
+    def _outcome(self, parse, text, default_timezone):
+        try:
+            parsed = parse(text, default_timezone)
+            return (parsed.replace(tzinfo=None), parsed.utcoffset(),
+                parsed.tzinfo is default_timezone)
+        except Exception as exc:
+            return type(exc)
+
+    def test_fuzzed_strings_match_regex(self):
+        other = helpers.FixedOffset(2, 0, '+02:00')
+        parsed = 0
+        for text in _random_datestrings(random.Random(12), 20000):
+            for default_timezone in (helpers.UTC, other):
+                outcome = self._outcome(helpers.parse_date, text,
+                    default_timezone)
+                self.assertEqual(outcome, self._outcome(_legacy_parse_date,
+                    text, default_timezone), text)
+                parsed += isinstance(outcome, tuple)
+        self.assertTrue(parsed > 10000)
+
+    def test_offsets_are_shared(self):
+        first = helpers.parse_date('2020-01-02T03:04:05+05:30')
+        second = helpers.parse_date('2021-06-07T08:09:10.5+05:30')
+        self.assertTrue(first.tzinfo is second.tzinfo)
+        self.assertEqual(first.utcoffset(), second.utcoffset())
+        self.assertRaises(helpers.ParseError, helpers.parse_date, 20200102)
+
+
+class ParseDatesTest(unittest.TestCase):
+    """ parse_dates against parse_date
+
+    """
+
+    def test_no_default_timezone_reads_utc(self):
+        values, mask = helpers.parse_dates(['2020-01-02T03:04:05Z',
+            '2020-01-02T03:04:05', '2020-01-02T03:04:05+01:00', 'bad'],
+            None)
+        self.assertEqual(list(mask), [0, 0, 0, 1])
+        self.assertEqual(list(values[:3]),
+            [1577934245.0, 1577934245.0, 1577930645.0])
+
+    def test_as_numpy_needs_numpy(self):
+        saved, helpers.numpy = helpers.numpy, None
+        try:
+            self.assertRaises(ValueError, helpers.parse_dates,
+                ['2020-01-02T03:04:05Z'], as_numpy=True)
+            values, mask = helpers.parse_dates(['2020-01-02T03:04:05Z'])
+            self.assertEqual(list(values), [1577934245.0])
+        finally:
+            helpers.numpy = saved
+
+
+def _legacy_encode_datetime(dateobject, class_='iso8601', tz_=None,
+        add_html=True):
+    """ encode_datetime as it was before the cached timezone tables
+
+    """
+    if not dateobject:
+        return ''
+
+    def wrap_html(iso_string, class_, date_string):
+        """ Return an html wrapped version of date
+
+        """
+        return '<div data-date="{0}" class="{1}" title="{2}">{2}</div>'.format(
+            iso_string, class_, date_string)
+
+    if type(dateobject) in (unicode, str):
+        try:
+            dateobject = datetime.fromtimestamp(float(dateobject))
+        except ValueError:
+            if not "<div" in dateobject and dateobject[-1] == "Z":
+                if add_html:
+                    return wrap_html(dateobject, 'iso8601', dateobject)
+                else:
+                    return dateobject
+            else:
+                return dateobject
+
+    iso_string = dateobject.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    if tz_:
+        dateobject = dateobject.replace(tzinfo=pytz.utc)
+        dateobject = dateobject.astimezone(pytz.timezone(tz_))
+
+    date_string = ''
+    if class_ == 'gridDate':
+        date_string = dateobject.strftime('%m-%d-%Y %I:%M %p')
+    elif class_ == 'iso8601':
+        date_string = iso_string
+
+    if add_html:
+        date_string = wrap_html(iso_string, class_, date_string)
+
+    return date_string
+
+
+_ZONES = ['US/Central', 'Europe/London', 'Australia/Lord_Howe',
+    'America/Sao_Paulo', 'Asia/Kolkata', 'UTC', 'Etc/GMT+5']
+
+
+def _random_utc_datetimes(random_, zone, count):
+    """ Naive UTC datetimes, half of them within a minute of one of the
+    zone's transitions
+
+    """
+    transitions = getattr(pytz.timezone(zone), '_utc_transition_times',
+        None) or [datetime(2000, 1, 1)]
+    transitions = [moment for moment in transitions if moment.year > 1900]
+    for _ in xrange(count):
+        if transitions and random_.random() < 0.5:
+            yield random_.choice(transitions) + timedelta(
+                seconds=random_.randint(-60, 60))
+        else:
+            yield datetime(1902, 1, 1) + timedelta(
+                seconds=random_.randint(0, 135 * 365 * 86400))
+
+
+class TimezoneTableTest(unittest.TestCase):
+    """ TimezoneTable and encode_datetime against astimezone on
+    pytz.timezone, what encode_datetime did per call
+
+    """
+
+    def test_conversions_match_astimezone(self):
+        random_ = random.Random(14)
+        for zone in _ZONES:
+            table = helpers.get_timezone_table(zone)
+            self.assertTrue(table is helpers.get_timezone_table(zone))
+            dateobjects = list(_random_utc_datetimes(random_, zone, 3000))
+            expected = [dateobject.replace(tzinfo=pytz.utc).astimezone(
+                pytz.timezone(zone)) for dateobject in dateobjects]
+            epochs = [calendar.timegm(dateobject.timetuple())
+                for dateobject in dateobjects]
+            for converted in (map(table.from_utc, dateobjects),
+                    table.from_utc_many(dateobjects),
+                    table.from_utc_many(dateobject.replace(tzinfo=pytz.utc)
+                    for dateobject in dateobjects)):
+                self.assertEqual([(moment.replace(tzinfo=None),
+                    moment.utcoffset(), moment.dst(), moment.tzname())
+                    for moment in converted], [(moment.replace(tzinfo=None),
+                    moment.utcoffset(), moment.dst(), moment.tzname())
+                    for moment in expected])
+            offsets = [moment.utcoffset().days * 86400 +
+                moment.utcoffset().seconds for moment in expected]
+            self.assertEqual(list(table.offsets(epochs)), offsets)
+            self.assertEqual(list(table.local_epochs(iter(epochs))),
+                [float(epoch + offset)
+                for epoch, offset in zip(epochs, offsets)])
+
+    def test_encode_datetime_matches_legacy(self):
+        random_ = random.Random(15)
+        for zone in _ZONES + [None]:
+            items = list(_random_utc_datetimes(random_, zone or 'UTC', 300))
+            items += ['%d' % random_.randint(0, 2 ** 31),
+                '1234.5', '2020-01-02T03:04:05Z', '<div>x</div>', '', None]
+            for item in items:
+                for class_ in ('gridDate', 'iso8601', 'other'):
+                    for add_html in (True, False):
+                        self.assertEqual(helpers.encode_datetime(item, class_,
+                            zone, add_html), _legacy_encode_datetime(item,
+                            class_, zone, add_html))
+
+
+class EncodeDatetimesTest(unittest.TestCase):
+    """ encode_datetimes against encode_datetime per item
+
+    """
+
+    def test_columns_match_per_item(self):
+        random_ = random.Random(16)
+        eastern = pytz.timezone('US/Eastern')
+        items = list(_random_utc_datetimes(random_, 'US/Central', 400))
+        items += [random_.choice(items) for _ in xrange(200)]
+        items += [eastern.localize(item) for item in items[:50]]
+        items += [item.replace(tzinfo=pytz.utc) for item in items[:50]]
+        items += ['%d' % random_.randint(0, 2 ** 31), '%d' % 1e9,
+            u'%d.25' % 1e9, '2020-01-02T03:04:05Z', u'2020-01-02T03:04:05Z',
+            '<div>x</div>', 'soon', '', u'', None, 0]
+        random_.shuffle(items)
+        for zone in ('US/Central', 'Etc/GMT+5', None):
+            for class_ in ('gridDate', 'iso8601', 'other', '50%', u'gridDate'):
+                for add_html in (True, False):
+                    self.assertEqual(helpers.encode_datetimes(iter(items),
+                        class_, zone, add_html), [helpers.encode_datetime(
+                        item, class_, zone, add_html) for item in items])
+                    self.assertEqual(helpers.encode_datetimes(items[:100],
+                        class_, zone, add_html), [_legacy_encode_datetime(
+                        item, class_, zone, add_html)
+                        for item in items[:100]])
+
+    def test_early_dates_fail_like_strftime(self):
+        for class_ in ('gridDate', 'iso8601'):
+            self.assertRaises(ValueError, helpers.encode_datetimes,
+                [datetime(1899, 12, 31)], class_)
+        self.assertEqual(helpers.encode_datetimes([]), [])
+
+
+def _legacy_decode_datetime(datestring):
+    """ decode_datetime before the fast paths, strip_tags then strptime
+
+    """
+    return datetime.strptime(helpers.strip_tags(datestring),
+        '%Y-%m-%dT%H:%M:%SZ')
+
+
+def _legacy_convert_datetime(dateitem, direction='string'):
+    """ convert_datetime before the fast paths, strftime and strptime
+
+    """
+    if direction == 'string':
+        return dateitem.strftime('%b %d %Y %I:%M:%S%f%p')
+    if dateitem:
+        return datetime.strptime(dateitem, '%b %d %Y %I:%M:%S%f%p')
+    return ''
+
+
+def _mutate(random_, text, noise, edits):
+    """ text with up to edits characters dropped, replaced or added
+
+    """
+    for _ in xrange(random_.randint(0, edits)):
+        pos = random_.randint(0, len(text))
+        action = random_.randint(0, 2)
+        if action == 0:
+            text = text[:pos] + text[pos + 1:]
+        else:
+            text = text[:pos] + random_.choice(noise) + \
+                text[pos + action - 1:]
+    return text
+
+
+def _outcome(function, *args):
+    """ Return value or exception type of a call
+
+    """
+    try:
+        return function(*args)
+    except Exception as exc:
+        return type(exc)
+
+
+class DecodeDatetimeTest(unittest.TestCase):
+    """ decode_datetime and convert_datetime against the strip_tags and
+    strptime versions
+
+    """
+
+    def test_decode_matches_strptime(self):
+        random_ = random.Random(17)
+        noise = '0123456789-:TZ <>/"=&;\n\xe9'
+        for dateobject in _random_utc_datetimes(random_, 'US/Central', 3000):
+            encoded = helpers.encode_datetime(dateobject, random_.choice(
+                ['iso8601', 'gridDate', 'other']),
+                random_.choice([None, 'US/Central']), random_.random() < 0.7)
+            text = _mutate(random_, encoded, noise, random_.choice([0, 1, 3]))
+            if random_.random() < 0.2:
+                text = text.decode('latin-1')
+            outcome = _outcome(helpers.decode_datetime, text)
+            self.assertEqual(outcome, _outcome(_legacy_decode_datetime, text),
+                repr(text))
+        texts = ['2010-09-14T20:30:22Z', ' 2010-09-14T20:30:22Z',
+            '<div data-date="2010-09-14T20:30:22Z">2010-09-14T20:30:21Z</div>',
+            '<div>2010-09-14T20:30:22Z</div>', '<b>2010-09-14T20:30:22Z</b>',
+            '<div title=">">2010-09-14T20:30:22Z</div>', '2010-9-14T20:30:22Z']
+        self.assertEqual(map(lambda text: _outcome(helpers.decode_datetimes,
+            [text]), texts), [_outcome(lambda text: [_legacy_decode_datetime(
+            text)], text) for text in texts])
+
+    def test_convert_matches_strftime(self):
+        random_ = random.Random(18)
+        noise = '0123456789 :APM'
+        for dateobject in _random_utc_datetimes(random_, 'US/Central', 3000):
+            dateobject = dateobject.replace(microsecond=random_.choice(
+                [0, 1, 999999, random_.randint(0, 999999)]))
+            text = helpers.convert_datetime(dateobject)
+            self.assertEqual(text, _legacy_convert_datetime(dateobject))
+            self.assertEqual(helpers.convert_datetime(text, 'datetime'),
+                dateobject)
+            text = _mutate(random_, text, noise, random_.choice([0, 1, 2]))
+            self.assertEqual(_outcome(helpers.convert_datetime, text,
+                'datetime'), _outcome(_legacy_convert_datetime, text,
+                'datetime'), repr(text))
+        items = list(_random_utc_datetimes(random_, 'UTC', 50))
+        texts = helpers.convert_datetimes(items)
+        self.assertEqual(texts, map(_legacy_convert_datetime, items))
+        self.assertEqual(helpers.convert_datetimes(texts + ['', None],
+            'datetime'), items + ['', ''])
+        self.assertRaises(ValueError, helpers.convert_datetimes,
+            [datetime(1899, 1, 1)])
+
+
+def _markov_model(markov):
+    """ Successor counts and seed weights per word pair of a MarkovText
+
+    """
+    vocab = markov._vocab
+    cache = {}
+    seeds = Counter()
+    prev_seed = 0
+    for state, key in enumerate(markov._keys):
+        pair = (vocab[key >> 32], vocab[key & 0xffffffff])
+        prev = 0
+        for idx in xrange(markov._offsets[state], markov._offsets[state + 1]):
+            cache.setdefault(pair, Counter())[
+                vocab[markov._successors[idx]]] += markov._weights[idx] - prev
+            prev = markov._weights[idx]
+        if markov._seeds[state] > prev_seed:
+            seeds[pair] = markov._seeds[state] - prev_seed
+        prev_seed = markov._seeds[state]
+    return cache, seeds
+
+
+def _markov_reference(words):
+    """ The dict of lists model MarkovText used to build, as counts
+
+    """
+    cache = {}
+    seeds = Counter()
+    if len(words) < 3:
+        return cache, seeds
+    for idx in xrange(len(words) - 2):
+        cache.setdefault((words[idx], words[idx + 1]), Counter())[
+            words[idx + 2]] += 1
+        seeds[(words[idx], words[idx + 1])] += 1
+    cache[(words[-2], words[-1])] = Counter([words[0]])
+    cache[(words[-1], words[0])] = Counter([words[1]])
+    return cache, seeds
+
+
+class MarkovTextTest(unittest.TestCase):
+    """ MarkovText against the original model, across its ways in
+
+    """
+
+    def setUp(self):
+        self.random = random.Random(3)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _text(self, alphabet='abcdefg', words=60):
+        return ' '.join(self.random.choice(alphabet)
+            for _ in xrange(self.random.randint(0, words)))
+
+    def _write(self, text, count):
+        """ Split text at spaces over `count` files
+
+        """
+        spaces = [idx for idx, char in enumerate(text) if char == ' ']
+        cuts = sorted(self.random.sample(spaces, min(len(spaces), count - 1)))
+        paths = []
+        for idx, (start, end) in enumerate(zip([0] + cuts,
+                cuts + [len(text)])):
+            paths.append(os.path.join(self.dir, 'part%d' % idx))
+            with open(paths[-1], 'wb') as file_:
+                file_.write(text[start:end])
+        return paths
+
+    def test_model_matches_reference(self):
+        texts = ['', 'one', 'one two', 'a b c', 'a a a a', 'x y x y z x y']
+        texts += [self._text() for _ in xrange(200)]
+        for text in texts:
+            self.assertEqual(_markov_model(helpers.MarkovText(text)),
+                _markov_reference(text.split()), text)
+
+    def test_chunks_and_shards(self):
+        for trial in xrange(100):
+            text = self._text('ab c\n', 80).replace('  ', ' ')
+            expected = _markov_model(helpers.MarkovText(text))
+            cuts = sorted(self.random.sample(xrange(len(text) + 1),
+                min(len(text) + 1, 6)))
+            chunks = [text[start:end] for start, end in zip([0] + cuts,
+                cuts + [len(text)])]
+            self.assertEqual(_markov_model(helpers.MarkovText(chunks)),
+                expected)
+            paths = self._write(text, self.random.randint(1, 3))
+            shard_size = self.random.randint(1, 40)
+            self.assertEqual(_markov_model(helpers.MarkovText.from_files(
+                paths, processes=1, shard_size=shard_size)), expected)
+            if trial % 25 == 0:
+                self.assertEqual(_markov_model(helpers.MarkovText.from_files(
+                    paths, processes=2, shard_size=shard_size)), expected)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy_and_pure_merge_agree(self):
+        text = self._text('abcdefghij', 3000)
+        paths = self._write(text, 3)
+        with_numpy = helpers.MarkovText.from_files(paths, processes=1,
+            shard_size=500)
+        helpers.numpy = None
+        try:
+            pure = helpers.MarkovText.from_files(paths, processes=1,
+                shard_size=500)
+        finally:
+            helpers.numpy = numpy
+        self.assertEqual(_markov_model(with_numpy), _markov_model(pure))
+        self.assertEqual(_markov_model(pure), _markov_reference(text.split()))
+
+    def test_update_save_and_load(self):
+        path = os.path.join(self.dir, 'model.mkv')
+        for _ in xrange(100):
+            first, second = self._text('abcd', 30), self._text('abcd', 30)
+            markov = helpers.MarkovText(first)
+            markov.update(second)
+            self.assertEqual(_markov_model(markov), _markov_reference(
+                (first + ' ' + second).split()))
+            markov.save(path)
+            for shared in (True, False):
+                loaded = helpers.MarkovText.load(path, shared)
+                self.assertEqual(_markov_model(loaded), _markov_model(markov))
+                loaded.update(first)
+                self.assertEqual(_markov_model(loaded), _markov_reference(
+                    ' '.join([first, second, first]).split()))
+
+    def test_shared_and_read_loads_agree(self):
+        path = os.path.join(self.dir, 'model.mkv')
+        for text in (self._text(words=300),
+                [u'caf\xe9 a b ', '\xff\xfe c d a b c \xe9t\xe9 ']):
+            markov = helpers.MarkovText(text)
+            markov.save(path)
+            shared = helpers.MarkovText.load(path, True)
+            read = helpers.MarkovText.load(path, False)
+            self.assertEqual(list(shared._vocab), list(markov._vocab))
+            self.assertEqual(map(type, shared._vocab),
+                map(type, markov._vocab))
+            self.assertEqual(map(type, read._vocab), map(type, markov._vocab))
+            for name in ('_keys', '_offsets', '_seeds', '_successors',
+                    '_weights', '_targets', '_aliases'):
+                values = list(getattr(read, name))
+                self.assertEqual(list(getattr(shared, name)), values, name)
+                self.assertEqual(map(type, getattr(shared, name)),
+                    map(type, values), name)
+                self.assertTrue(all(value >= 0 for value in values), name)
+
+    def test_alias_tables_are_exact(self):
+        markov = helpers.MarkovText(self._text('abc', 3000))
+        probs, aliases = markov._alias_tables()
+        self.assertTrue(markov._alias_tables()[0] is probs)
+        offsets, weights = markov._offsets, markov._weights
+        for state in xrange(len(markov._keys)):
+            low, high = offsets[state], offsets[state + 1]
+            drawn = [0.0] * (high - low)
+            for column in xrange(high - low):
+                drawn[column] += probs[low + column]
+                drawn[aliases[low + column]] += 1 - probs[low + column]
+            total = float(weights[high - 1])
+            for column in xrange(high - low):
+                count = weights[low + column] - (weights[low + column - 1]
+                    if column else 0)
+                self.assertAlmostEqual(drawn[column] / (high - low),
+                    count / total, places=12)
+
+    def test_seeded_generation_repeats(self):
+        text = self._text(words=500)
+        markov = helpers.MarkovText(text, seed=1)
+        self.assertEqual(markov.generate_markov_text(),
+            helpers.MarkovText(text, seed=1).generate_markov_text())
+        self.assertEqual(markov.generate_many(20, 10, seed=5),
+            markov.generate_many(20, 10, seed=5))
+        if numpy is not None:
+            self.assertEqual(markov.generate_many(20, 10, 5, True),
+                markov.generate_many(20, 10, 5, True))
+
+
+class _Writes(object):
+    """ File object keeping every write apart
+
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+
+def _lorem_shape(paragraphs):
+    """ Sentences per paragraph, sections per sentence, words per section,
+    end marks and word counts, checking each section is a sample
+
+    """
+    shape = [Counter(), Counter(), Counter(), Counter(), Counter()]
+    words = set(helpers.LoremIpsum._words)
+    for paragraph in paragraphs:
+        sentences = paragraph.replace('. ', '.\0').replace('? ',
+            '?\0').split('\0')
+        shape[0][len(sentences)] += 1
+        for sentence in sentences:
+            assert sentence[0].isupper(), paragraph
+            shape[3][sentence[-1]] += 1
+            sections = sentence[:-1].lower().split(', ')
+            shape[1][len(sections)] += 1
+            for section in sections:
+                section = section.split(' ')
+                assert len(set(section)) == len(section), paragraph
+                assert words.issuperset(section), paragraph
+                shape[2][len(section)] += 1
+                shape[4].update(section)
+    return shape
+
+
+class LoremIpsumTest(unittest.TestCase):
+    """ LoremIpsum.write against paragraph()
+
+    """
+
+    def _write(self, **kwargs):
+        file_ = _Writes()
+        written = helpers.LoremIpsum().write(file_, **kwargs)
+        self.assertEqual(written, len(file_.getvalue()))
+        return file_
+
+    def _assert_close(self, shape, expected):
+        for counts, reference in zip(shape, expected):
+            total, reference_total = float(sum(counts.values())), \
+                float(sum(reference.values()))
+            for key in set(counts) | set(reference):
+                self.assertAlmostEqual(counts[key] / total,
+                    reference[key] / reference_total, delta=0.03)
+
+    def test_seeded_shards_and_pool(self):
+        text = self._write(paragraphs=100, seed=22, shard_size=16).getvalue()
+        self.assertEqual(text.count('\n\n'), 100)
+        self.assertTrue(text.endswith('.\n\n') or text.endswith('?\n\n'))
+        self.assertEqual(self._write(paragraphs=100, seed=22,
+            shard_size=16).getvalue(), text)
+        self.assertNotEqual(self._write(paragraphs=100, seed=23,
+            shard_size=16).getvalue(), text)
+        for processes in (1, 2):
+            file_ = self._write(paragraphs=100, seed=22, shard_size=16,
+                processes=processes)
+            self.assertEqual(file_.getvalue(), text)
+            self.assertEqual([chunk.count('\n\n') for chunk in file_.chunks],
+                [16] * 6 + [4])
+        self.assertEqual(self._write(paragraphs=100, seed=22, shard_size=16,
+            separator='\n').getvalue().count('\n'), 100)
+        self.assertRaises(ValueError, self._write, seed=22)
+        self.assertRaises(ValueError, self._write, paragraphs=1, size=1)
+
+    def test_size_cuts_the_same_stream(self):
+        text = self._write(paragraphs=200, seed=24, shard_size=8).getvalue()
+        for size in (0, 1, 1000, len(text) - 1, len(text)):
+            for processes in (1, 2):
+                self.assertEqual(self._write(size=size, seed=24,
+                    shard_size=8, processes=processes).getvalue(),
+                    text[:size])
+
+    def test_distribution_matches_paragraph(self):
+        state = random.getstate()
+        random.seed(25)
+        try:
+            expected = _lorem_shape(helpers.LoremIpsum().paragraph()
+                for _ in xrange(4000))
+        finally:
+            random.setstate(state)
+        text = self._write(paragraphs=4000, seed=26).getvalue()
+        self._assert_close(_lorem_shape(text.split('\n\n')[:-1]), expected)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy_shards(self):
+        text = self._write(paragraphs=4000, seed=27, shard_size=512,
+            use_numpy=True).getvalue()
+        self.assertEqual(text, self._write(paragraphs=4000, seed=27,
+            shard_size=512, use_numpy=True, processes=2).getvalue())
+        self.assertNotEqual(text, self._write(paragraphs=4000, seed=27,
+            shard_size=512).getvalue())
+        state = random.getstate()
+        random.seed(28)
+        try:
+            expected = _lorem_shape(helpers.LoremIpsum().paragraph()
+                for _ in xrange(4000))
+        finally:
+            random.setstate(state)
+        self._assert_close(_lorem_shape(text.split('\n\n')[:-1]), expected)
+        helpers.numpy = None
+        try:
+            self.assertEqual(self._write(paragraphs=50, seed=27,
+                use_numpy=True).getvalue(), self._write(paragraphs=50,
+                seed=27).getvalue())
+        finally:
+            helpers.numpy = numpy
+
+
+def _legacy_ip_addr_range(start_addr, end_addr):
+    """ The incr_addr/as_string generator ip_addr_range used to be
+
+    """
+    def incr_addr(addr_list):
+        addr_list[3] += 1
+        for i in (3, 2, 1):
+            if addr_list[i] == 256:
+                addr_list[i] = 0
+                addr_list[i - 1] += 1
+
+    start_addr_list = map(int, start_addr.split('.'))
+    end_addr_list = map(int, end_addr.split('.'))
+    cur_addr_list = start_addr_list[:]
+    yield '.'.join(map(str, cur_addr_list))
+    for i in range(4):
+        while cur_addr_list[i] < end_addr_list[i]:
+            incr_addr(cur_addr_list)
+            yield '.'.join(map(str, cur_addr_list))
+
+
+def _legacy_ips_from_ranges(ranges):
+    """ get_list_of_ips_from_ranges before IPSet, quadratic
+
+    """
+    range_list = []
+    ranges = [ran_.strip() for ran_ in ranges.split('\n') if ran_]
+    ranges = [ran_.split('-') for ran_ in ranges if ran_]
+    for range_ in ranges:
+        if len(range_) == 2:
+            range_list.append(range_[0])
+            for addr in _legacy_ip_addr_range(range_[0], range_[1]):
+                if addr not in range_list:
+                    range_list.append(addr)
+    return range_list
+
+
+def _random_ranges(random_, count, base=None, width=600):
+    """ (start, end) int pairs with start <= end, close enough together
+    to overlap and touch
+
+    """
+    if base is None:
+        base = random_.randint(0, 2 ** 32 - 20000)
+    ranges = []
+    for _ in xrange(count):
+        start = base + random_.randint(0, 4000)
+        ranges.append((start, start + random_.randint(0, width)))
+    return ranges
+
+
+class IPSetTest(unittest.TestCase):
+    """ IPSet and get_list_of_ips_from_ranges against the list scan
+    they replaced
+
+    """
+
+    def test_ranges_text_matches_legacy(self):
+        random_ = random.Random(11)
+        for trial in xrange(60):
+            ranges = _random_ranges(random_, random_.randint(0, 6),
+                (256 ** 3 - 2000) * (trial % 2))
+            lines = ['%s-%s' % (helpers.int_to_ip(start),
+                helpers.int_to_ip(end)) for start, end in ranges]
+            lines.insert(random_.randint(0, len(lines)), 'not a range')
+            text = '\n'.join(lines) + '\n'
+            expected = _legacy_ips_from_ranges(text)
+            self.assertEqual(helpers.get_list_of_ips_from_ranges(text),
+                expected)
+            ips = helpers.IPSet.from_text(text)
+            self.assertEqual(sorted(set(expected),
+                key=helpers.ip_to_int), list(ips))
+            self.assertEqual(len(ips), len(set(expected)))
+            self.assertEqual(list(ips.iter_ints()),
+                sorted(set(map(helpers.ip_to_int, expected))))
+
+    def test_membership_and_missing(self):
+        random_ = random.Random(12)
+        for _ in xrange(100):
+            ranges = _random_ranges(random_, random_.randint(0, 8), 5000, 300)
+            ips = helpers.IPSet(ranges)
+            members = set()
+            for start, end in ranges:
+                members.update(xrange(start, end + 1))
+            for start, end in ips.ranges():
+                self.assertFalse(start - 1 in members or end + 1 in members)
+            for value in xrange(4990, 9400, 7):
+                self.assertEqual(value in ips, value in members)
+                self.assertEqual(helpers.int_to_ip(value) in ips,
+                    value in members)
+            start = random_.randint(4900, 9000)
+            end = start + random_.randint(0, 600)
+            self.assertEqual([value for gap in ips.missing(start, end)
+                for value in xrange(gap[0], gap[1] + 1)],
+                [value for value in xrange(start, end + 1)
+                    if value not in members])
+
+
+def _reference_cidrs(start, end, low=0, bits=32):
+    """ CIDR cover of start-end by halving the address space, minimal
+    by construction
+
+    """
+    high = low + (1 << bits) - 1
+    if high < start or low > end:
+        return []
+    if start <= low and high <= end:
+        return ['%s/%d' % (helpers.int_to_ip(low), 32 - bits)]
+    half = 1 << (bits - 1)
+    return _reference_cidrs(start, end, low, bits - 1) + \
+        _reference_cidrs(start, end, low + half, bits - 1)
+
+
+class IPRangeTest(unittest.TestCase):
+    """ IPRange and ip_addr_range against the old generator as a list
+
+    """
+
+    def test_sequence_matches_legacy_list(self):
+        random_ = random.Random(14)
+        for trial in xrange(150):
+            start, end = _random_ranges(random_, 1,
+                random_.choice([0, 256 ** 2 - 300, 2 ** 32 - 4600]))[0]
+            end = min(end, 2 ** 32 - 1)
+            first, last = helpers.int_to_ip(start), helpers.int_to_ip(end)
+            expected = list(_legacy_ip_addr_range(first, last))
+            addrs = helpers.IPRange(first, last)
+            generated = helpers.ip_addr_range(first, last)
+            self.assertEqual(next(generated), expected[0])
+            self.assertEqual([expected[0]] + list(generated), expected)
+            self.assertEqual(list(addrs), expected)
+            self.assertEqual(len(addrs), len(expected))
+            self.assertEqual(list(addrs.ints()),
+                map(helpers.ip_to_int, expected))
+            self.assertEqual(addrs.to_array().tolist(), list(addrs.ints()))
+            for _ in xrange(5):
+                idx = random_.randint(-len(expected), len(expected) - 1)
+                self.assertEqual(addrs[idx], expected[idx])
+                self.assertTrue(expected[idx] in addrs)
+                low = random_.randint(-len(expected) - 2, len(expected) + 2)
+                high = random_.randint(-len(expected) - 2, len(expected) + 2)
+                step = random_.choice([None, 1, 1, 3, -2])
+                piece = addrs[low:high:step]
+                self.assertEqual(list(piece), expected[low:high:step])
+                if step in (None, 1):
+                    self.assertTrue(isinstance(piece, helpers.IPRange))
+                    self.assertEqual(len(piece), len(expected[low:high]))
+            self.assertRaises(IndexError, addrs.__getitem__, len(expected))
+            self.assertFalse(helpers.int_to_ip((end + 1) % 2 ** 32) in addrs)
+            self.assertEqual(addrs.cidrs(), _reference_cidrs(start, end))
+
+    def test_empty_slices(self):
+        addrs = helpers.IPRange('10.0.0.250', '10.0.1.5')
+        for empty in (addrs[5:2], addrs[3:3], addrs[20:], addrs[0:0][:]):
+            self.assertTrue(isinstance(empty, helpers.IPRange))
+            self.assertEqual((len(empty), list(empty), empty.cidrs()),
+                (0, [], []))
+            self.assertEqual(empty, helpers.IPRange(0, 5)[0:0])
+            self.assertFalse('10.0.0.250' in empty)
+            self.assertRaises(IndexError, empty.__getitem__, 0)
+        self.assertNotEqual(addrs[0:0], addrs[0:1])
+
+    def test_collapse_matches_reference(self):
+        random_ = random.Random(15)
+        for _ in xrange(100):
+            ranges = _random_ranges(random_, random_.randint(0, 6), 4096,
+                random_.choice([10, 500, 3000]))
+            members = set()
+            for start, end in ranges:
+                members.update(xrange(start, end + 1))
+            expected = []
+            for start, end in helpers.IPSet(ranges).ranges():
+                expected.extend(_reference_cidrs(start, end))
+            self.assertEqual(helpers.collapse_cidrs(ranges), expected)
+            self.assertEqual(helpers.collapse_cidrs(
+                [helpers.IPRange(*range_) for range_ in ranges]), expected)
+            covered = set()
+            for block in expected:
+                addr, prefix = block.split('/')
+                start = helpers.ip_to_int(addr)
+                covered.update(xrange(start, start + (1 << 32 - int(prefix))))
+            self.assertEqual(covered, members)
+
+
+class IPRangeIndexTest(unittest.TestCase):
+    """ IPRangeIndex against a scan of every range
+
+    """
+
+    def test_lookups_match_scan(self):
+        random_ = random.Random(13)
+        for _ in xrange(40):
+            ranges = _random_ranges(random_, random_.randint(0, 12),
+                10 ** 6, random_.choice([0, 20, 2000]))
+            labelled = [(start, end, 'r%d' % idx)
+                for idx, (start, end) in enumerate(ranges)]
+            index = helpers.IPRangeIndex(labelled)
+            values = [random_.randint(10 ** 6 - 10, 10 ** 6 + 7000)
+                for _ in xrange(300)] + [start for start, _ in ranges] + \
+                [end + 1 for _, end in ranges]
+            expected = []
+            for value in values:
+                # smallest range wins, ties go to the first listed
+                hits = [(end - start, idx) for idx, (start, end)
+                    in enumerate(ranges) if start <= value <= end]
+                expected.append(min(hits)[1] if hits else -1)
+            addrs = map(helpers.int_to_ip, values)
+            self.assertEqual([index.owner(addr) for addr in addrs], expected)
+            self.assertEqual(list(index.owners(addrs)), expected)
+            self.assertEqual(list(index.owners(values)), expected)
+            if numpy is not None:
+                self.assertEqual(list(index.owners(numpy.array(values))),
+                    expected)
+            self.assertEqual(index.lookup_many(addrs), [
+                (helpers.int_to_ip(ranges[idx][0]),
+                helpers.int_to_ip(ranges[idx][1]), 'r%d' % idx)
+                if idx >= 0 else None for idx in expected])
+
+    def test_owners_parses_like_owner(self):
+        index = helpers.IPRangeIndex.from_text('''
+            10.0.0.0-10.0.0.255 low
+            10.1.0.0-10.1.0.255 high''')
+        self.assertEqual(list(index.owners(['10.0.0.8', '010.1.0.8'])),
+            [0, 1])
+        self.assertEqual(index.owner('010.1.0.8'), 1)
+        for addr in ('10.1', '10.1.0', '1', '0x0a.0.0.1'):
+            for lookup in (index.owner, lambda addr: index.owners([addr])):
+                self.assertRaises((IndexError, ValueError), lookup, addr)
+
+
+class RetryTest(unittest.TestCase):
+    """ Retry and CircuitBreaker
+
+    """
+
+    def test_backoff_and_counters(self):
+        waits = []
+        retry = helpers.Retry(4, delay=1, backoff=2, max_delay=3,
+            sleep=waits.append)
+        @retry
+        def fail():
+            raise IOError('down')
+        self.assertRaises(IOError, fail)
+        self.assertEqual(waits, [1, 2, 3])
+        self.assertEqual((retry.attempts, retry.failures, retry.giveups),
+            (4, 4, 1))
+
+    def test_other_exception_only_releases_trial(self):
+        breaker = helpers.CircuitBreaker(1, reset=0)
+        @helpers.Retry(1, exceptions=IOError, breaker=breaker)
+        def down():
+            raise IOError('down')
+        @helpers.Retry(1, exceptions=IOError, breaker=breaker)
+        def bug():
+            raise KeyError('bug')
+        self.assertRaises(IOError, down)
+        opened = breaker.opened
+        self.assertRaises(KeyError, bug)
+        self.assertEqual((breaker.opened, breaker.failures), (opened, 1))
+        # the trial was given back, the next call may still try
+        self.assertRaises(IOError, down)
+        self.assertEqual(breaker.failures, 2)
+
+
+class RetryMapTest(unittest.TestCase):
+    """ retry_map ordering, failures and the concurrency cap
+
+    """
+
+    def test_orders_and_collects_failures(self):
+        def half(value):
+            if value % 5 == 0:
+                raise ValueError(value)
+            return value / 2
+        results = list(helpers.retry_map(half, xrange(100), 4))
+        self.assertEqual([index for index, _, _ in results], range(100))
+        for index, result, error in results:
+            if index % 5 == 0:
+                self.assertTrue(isinstance(error, ValueError))
+            else:
+                self.assertEqual((result, error), (index / 2, None))
+        unordered = list(helpers.retry_map(half, xrange(100), 4,
+            ordered=False))
+        self.assertEqual(sorted(index for index, _, _ in unordered),
+            range(100))
+
+    def test_base_exceptions_come_back(self):
+        def leave(value):
+            if value == 3:
+                raise SystemExit(value)
+            if value == 5:
+                raise GeneratorExit()
+            return value
+        for timeout in (None, 1):
+            results = list(helpers.retry_map(leave, xrange(10), 2,
+                timeout=timeout))
+            self.assertEqual([result for _, result, _ in results],
+                [0, 1, 2, None, 4, None, 6, 7, 8, 9])
+            self.assertTrue(isinstance(results[3][2], SystemExit))
+            self.assertTrue(isinstance(results[5][2], GeneratorExit))
+
+    def test_timeouts_keep_the_cap(self):
+        lock = threading.Lock()
+        running = [0, 0]
+        def hang(value):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            try:
+                time.sleep(0.2)
+            finally:
+                with lock:
+                    running[0] -= 1
+        results = list(helpers.retry_map(hang, xrange(10), 2,
+            helpers.Retry(2), timeout=0.05))
+        self.assertEqual(running[1], 2)
+        for _, _, error in results:
+            self.assertTrue(isinstance(error, helpers.CallTimeoutError))
+
+
+class TimingsTest(unittest.TestCase):
+    """ Timings clock, sampling and histogram
+
+    """
+
+    def test_clock_is_monotonic_ns(self):
+        values = [helpers.monotonic_ns() for _ in xrange(10000)]
+        self.assertTrue(all(isinstance(value, (int, long)) for value in values))
+        self.assertEqual(values, sorted(values))
+        start = helpers.monotonic_ns()
+        time.sleep(0.01)
+        self.assertTrue(10 ** 7 <= helpers.monotonic_ns() - start < 10 ** 9)
+
+    def test_trivial_calls_and_sampling(self):
+        timings = helpers.Timings(sample=10)
+        @timings.timed(name='noop')
+        def noop():
+            pass
+        for _ in xrange(5000):
+            noop()
+        stats = timings.stats('noop')
+        self.assertEqual((stats.calls, stats.count), (5000, 500))
+        self.assertTrue(0 < stats.min <= stats.percentile(50) <= stats.max)
+        stats.reset()
+        for _ in xrange(25):
+            noop()
+        self.assertEqual((stats.calls, stats.count), (25, 3))
+
+    def test_print_timing_only_reports_success(self):
+        @helpers.print_timing
+        def fail():
+            raise KeyError('fail')
+        stats = helpers.TIMINGS.stats('%s.fail' % __name__)
+        self.assertRaises(KeyError, fail)
+        self.assertEqual((stats.calls, stats.count), (1, 0))
+
+    def test_percentiles_within_bucket(self):
+        stats = helpers.TimingStats('values')
+        values = range(1, 100001)
+        random.Random(2).shuffle(values)
+        threads = [threading.Thread(target=map, args=(stats.record,
+            values[idx::4])) for idx in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((stats.count, stats.min, stats.max), (100000, 1,
+            100000))
+        self.assertEqual(stats.total, sum(values))
+        for percent in (50, 99, 99.9):
+            self.assertAlmostEqual(stats.percentile(percent) / 1000.0,
+                percent, delta=percent * 0.016)
+
+
+if __name__ == '__main__':
+    unittest.main()